@@ -1,10 +1,8 @@
 """Extract group chats from iMessage chat.db
 """
-import datetime
 import os
 import sqlite3
 
-from collections import defaultdict
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, List, Optional
@@ -36,35 +34,40 @@ WITH group_chat_names AS (
 
 ), messages AS (
 
-    -- Collect conversations they're in and de-dupe.
+    -- Collect conversations they're in. Chats are matched with IN rather than joined
+    -- per handle, so each msg appears once per chat without a GROUP BY de-dupe.
     SELECT
         chat.rowid "chatid",
         message.rowid "msgid",
         chat.display_name "chat_name",
-        datetime (message.date / 1000000000 + strftime ("%s", "2001-01-01"), "unixepoch", "localtime") AS timestamp,
+        -- message.date is ns since 2001-01-01; shift to unix epoch ns.
+        message.date + CAST(strftime ("%s", "2001-01-01") AS INTEGER) * 1000000000 AS timestamp,
         message.text,
         message.handle_id,
         -- Ah, so for not my msgs, use handles. But for my msgs, seems is_from_me is the source-of-truth.
         message.is_from_me
     FROM
-        group_chat_handles
-        JOIN chat_handle_join ON chat_handle_join.handle_id = group_chat_handles.rowid
-        JOIN chat ON chat.rowid = chat_handle_join.chat_id
+        chat
         JOIN chat_message_join ON chat_message_join.chat_id = chat.rowid
         JOIN message ON message.rowid = chat_message_join.message_id
-    GROUP BY chatid, msgid
+    WHERE chat.rowid IN (
+        SELECT chat_handle_join.chat_id
+        FROM group_chat_handles
+        JOIN chat_handle_join ON chat_handle_join.handle_id = group_chat_handles.rowid
+    )
 
 ), filtered_messages AS (
 
     -- Filter out non-group chat msgs and tapback/react msgs.
+    -- Speakers are capitalized here (eg 'JEREMY' -> 'Jeremy') rather than per-row in Python.
     SELECT
         chat_name,
         CASE
-            WHEN name IS NOT NULL then name
+            WHEN name IS NOT NULL then UPPER(SUBSTR(name, 1, 1)) || LOWER(SUBSTR(name, 2))
             ELSE
                 CASE
-                    WHEN messages.is_from_me THEN 'jeremy'
-                    ELSE group_chat_handles.id
+                    WHEN messages.is_from_me THEN 'Jeremy'
+                    ELSE UPPER(SUBSTR(group_chat_handles.id, 1, 1)) || LOWER(SUBSTR(group_chat_handles.id, 2))
                 END
         END speaker,
         text,
@@ -74,27 +77,60 @@ WITH group_chat_names AS (
     WHERE
         chat_name != ''
         AND text IS NOT NULL
+        -- Unicode object replacement character, ie attachments.
+        AND instr(text, char(65532)) = 0
         -- TODO use this as signal for up-sampling.
-        AND text NOT LIKE 'Loved%'
-        AND text NOT LIKE 'Liked%'
-        AND text NOT LIKE 'Disliked%'
-        AND text NOT LIKE 'Laughed at%'
-        AND text NOT LIKE 'Emphasized%'
-        AND text NOT LIKE 'Questioned%'
-        AND text NOT LIKE 'Removed%'
+        -- Most msgs don't start with a tapback's first letter (l, d, e, q, r in either case,
+        -- via | 32), so they skip the LIKEs.
+        AND (
+            (unicode(text) | 32) NOT IN (108, 100, 101, 113, 114)
+            OR (
+                text NOT LIKE 'Loved%'
+                AND text NOT LIKE 'Liked%'
+                AND text NOT LIKE 'Disliked%'
+                AND text NOT LIKE 'Laughed at%'
+                AND text NOT LIKE 'Emphasized%'
+                AND text NOT LIKE 'Questioned%'
+                AND text NOT LIKE 'Removed%'
+            )
+        )
+
+), trimmed_messages AS (
+
+    -- Strip the same whitespace as Python's str.strip().
+    SELECT
+        chat_name,
+        speaker,
+        TRIM(text, char(9, 10, 11, 12, 13, 28, 29, 30, 31, 32, 133, 160, 5760, 8192, 8193, 8194, 8195, 8196, 8197, 8198, 8199, 8200, 8201, 8202, 8232, 8233, 8239, 8287, 12288)) AS text,
+        timestamp
+    FROM filtered_messages
 
 )
 
-SELECT *
-FROM filtered_messages
+-- Chat lengths come along with each row so chats can be pre-sized, and each msg's
+-- "speaker: text" line is formatted here so rows map straight onto Message.
+-- Chats come back in alphabetical order of chat_name, which also fixes the first-seen
+-- speaker order (and so the speaker list in dataset.py's instruction prompt).
+SELECT
+    chat_name,
+    COUNT(*) OVER (PARTITION BY chat_name) AS chat_length,
+    speaker,
+    text,
+    timestamp,
+    COALESCE(speaker, 'Unknown speaker') || ': ' || text AS line
+FROM trimmed_messages
+ORDER BY chat_name, timestamp
 """
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Message:
     speaker: Optional[str]
     text: str
-    timestamp: datetime.datetime
+    # Unix epoch nanoseconds. Kept as an int; convert with datetime.fromtimestamp(timestamp_ns / 1e9) if needed.
+    timestamp_ns: int
+    # Formatted "speaker: text" line, cached since it's reused by every partial conversation.
+    line: str
 
 
 def extract_group_chats(chat_name: str) -> Dict[str, List[Message]]:
@@ -102,26 +138,24 @@ def extract_group_chats(chat_name: str) -> Dict[str, List[Message]]:
     if not os.path.exists(CHATDB_PATH):
         raise FileNotFoundError(CHATDB_PATH)
 
-    with sqlite3.connect(CHATDB_PATH) as conn:
+    chats = {}
+    # Read-only, and tuned for a single large read: mmap the db, a 256MB page cache, and
+    # in-memory temp storage for the IN-subquery chat list, the chat_length window
+    # partition and the ORDER BY.
+    with sqlite3.connect(f"{Path(CHATDB_PATH).as_uri()}?mode=ro", uri=True) as conn:
+        conn.execute("PRAGMA mmap_size = 30000000000")
+        conn.execute("PRAGMA cache_size = -262144")
+        conn.execute("PRAGMA temp_store = MEMORY")
         cursor = conn.cursor()
         cursor.execute(READ_QUERY, [f"%{chat_name}%"])
-        result_set = cursor.fetchall()
-
-    chats = defaultdict(list)
-    for row in result_set:
-        chat_name, speaker, text, raw_timestamp = row
-        text = text.strip()
-        if speaker is not None:
-            speaker = speaker[0].upper() + speaker[1:].lower()
-        timestamp = datetime.datetime.fromisoformat(raw_timestamp)
-
-        # Unicode object replacement character
-        if any(ord(char) == 65532 for char in text):
-            continue
-
-        chats[chat_name].append(Message(speaker, text, timestamp))
 
-    for chat_name, chat in chats.items():
-        chats[chat_name] = sorted(chat, key=lambda m: m.timestamp)
+        # Stream rows rather than materializing the whole result set. Rows arrive grouped by
+        # chat and sorted by timestamp, so each chat is filled in order.
+        for chat_name, chat_length, speaker, text, timestamp_ns, line in cursor:
+            if chat_name not in chats:
+                chat = chats[chat_name] = [None] * chat_length
+                i = 0
+            chat[i] = Message(speaker, text, timestamp_ns, line)
+            i += 1
 
     return chats
@@ -1,16 +1,19 @@
 """From group chats, extract conversations, auto-regressible partial conversations, and finally llama/alpaca-specific json format.
 """
-import json
 import numpy as np
-import random
+import orjson
 
 from collections import Counter
-from datetime import datetime, timedelta
+from itertools import accumulate
+from numba import njit
 from typing import List
 
 from chatdb import extract_group_chats, Message
 
 
+DATASET_PATH = "dataset.jsonl"
+
+
 def construct_conversations(
     chat: List[Message], boundary_duration: int = 2
 ) -> List[List[Message]]:
@@ -18,48 +21,57 @@ def construct_conversations(
 
     Start with a simple heuristic: conversations are {boundary_duration} hours apart.
     """
-    conversations, conversation = [], []
-
-    start_timestamp = datetime.min
-    for msg in chat:
-        if msg.timestamp - start_timestamp > timedelta(hours=boundary_duration):
-            if conversation:
-                conversations.append(conversation)
-            conversation = [msg]
-            start_timestamp = msg.timestamp
-        else:
-            conversation.append(msg)
-
-    return conversations
-
-
-def construct_example(partial_conversation: List[Message], instruction: str) -> dict:
-    """Example with instruction, input, output keys for llama, alpaca fine-tuning."""
-    context = "\n".join(
-        [
-            f"{msg.speaker}: {msg.text}"
-            if msg.speaker is not None
-            else f"Unknown speaker: {msg.text}"
-            for msg in partial_conversation[:-1]
-        ]
-    )
-    # Approx 256 tokens.
-    if len(context) > 256 * 4:
-        context = "\n".join(
-            [
-                f"{msg.speaker}: {msg.text}"
-                if msg.speaker is not None
-                else f"Unknown speaker: {msg.text}"
-                for msg in partial_conversation[len(partial_conversation) // 2 : -1]
-            ]
+    if not chat:
+        return []
+
+    timestamps = np.array([msg.timestamp_ns for msg in chat], dtype=np.int64)
+    threshold = boundary_duration * 3_600_000_000_000  # ns
+    starts = list(_conversation_starts(timestamps, threshold))
+
+    return [chat[start:end] for start, end in zip(starts, starts[1:] + [len(chat)])]
+
+
+@njit(cache=True)
+def _conversation_starts(timestamps: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of each conversation's first msg, given int64 timestamps and threshold in the same unit."""
+    starts = np.empty(len(timestamps), np.int64)
+    starts[0] = 0
+    k = 1
+    start_timestamp = timestamps[0]
+    for i in range(1, len(timestamps)):
+        if timestamps[i] - start_timestamp > threshold:
+            starts[k] = i
+            k += 1
+            start_timestamp = timestamps[i]
+    return starts[:k]
+
+
+def construct_examples(conversation: List[Message], instruction: str) -> List[dict]:
+    """Examples with instruction, input, output keys for llama, alpaca fine-tuning.
+
+    One example per partial conversation conversation[: i + 1] whose last msg has a known speaker.
+    """
+    # Join the conversation once; each context is then a substring between line offsets.
+    lines = "\n".join(msg.line for msg in conversation)
+    offsets = list(accumulate((len(msg.line) + 1 for msg in conversation), initial=0))
+
+    examples = []
+    for i, last_msg in enumerate(conversation):
+        if last_msg.speaker is None:
+            continue
+        start = 0
+        # Approx 256 tokens.
+        if offsets[i] - 1 > 256 * 4:
+            start = (i + 1) // 2
+        context = lines[offsets[start] : max(offsets[i] - 1, offsets[start])]
+        examples.append(
+            {
+                "instruction": instruction,
+                "input": f"Conversation:\n{context}\n{last_msg.speaker}: ",
+                "output": last_msg.text,
+            }
         )
-    context = "Conversation:\n" + context + "\n"
-    last_msg = partial_conversation[-1]
-    return {
-        "instruction": instruction,
-        "input": context + f"{last_msg.speaker}: ",
-        "output": last_msg.text,
-    }
+    return examples
 
 
 if __name__ == "__main__":
@@ -82,12 +94,11 @@ if __name__ == "__main__":
 
     # First pass at filtering
     # Remove single message conversations that are urls or that are fewer than 10 chars...
-    filtered_conversations = []
-    for c in conversations:
-        if len(c) == 1 and (c[0].text.startswith("http") or len(c[0].text) <= 10):
-            continue
-        else:
-            filtered_conversations.append(c)
+    filtered_conversations = [
+        c
+        for c in conversations
+        if not (len(c) == 1 and (len(c[0].text) <= 10 or c[0].text.startswith("http")))
+    ]
     print(
         "After applying filters: ",
         len(conversations),
@@ -96,29 +107,29 @@ if __name__ == "__main__":
     )
     conversations = filtered_conversations
 
-    speaker_counts = Counter()
-    for c in conversations:
-        for m in c:
-            speaker_counts[m.speaker] += 1
+    speaker_counts = Counter(m.speaker for c in conversations for m in c)
     print("Speaker counts".center(40, "="))
     print(speaker_counts)
 
-    partial_conversations = [
-        c[: i + 1]
-        for c in conversations
-        for i in range(len(c))
-        if c[i].speaker is not None
-    ]
-
     speakers = [speaker for speaker in speaker_counts.keys() if speaker is not None]
 
     instructions = f"""The conversation below is a group chat among friends: {", ".join(speakers)}. The group chat usually consists of sharing updates or content, telling jokes or teasing one another in good fun. You should be funny, have no filter, and even be rude and curse.
 
 You will see the most recent messages in the group chat, if there are any, and you should start or continue the conversation as the indicated speaker."""
 
-    dataset = [construct_example(pc, instructions) for pc in partial_conversations]
-    random.shuffle(dataset)
+    # Every example references this one string object.
+    instructions = sys.intern(instructions)
+    dataset = [ex for c in conversations for ex in construct_examples(c, instructions)]
+    # Seeded so the written dataset's order is reproducible.
+    permutation = np.random.default_rng(0).permutation(len(dataset))
+    dataset = [dataset[i] for i in permutation]
 
     for ex in dataset[:5]:
         print()
         print(ex)
+
+    # One json example per line.
+    with open(DATASET_PATH, "wb") as f:
+        f.write(b"".join(orjson.dumps(ex) + b"\n" for ex in dataset))
+    print()
+    print(f"Wrote {len(dataset)} examples to {DATASET_PATH}")